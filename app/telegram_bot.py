@@ -2,38 +2,46 @@
 """
 Telegram bot transport (pytelegrambotapi)
 
-‣ Uses long-polling for dev ease.
-‣ One Chunker + one SendQueue per user_id (stored in dicts).
+‣ Uses long-polling (50 s server-side hold) with a worker thread pool sized
+  for the I/O-bound handlers.
+‣ One Chunker + one SendQueue per user_id (stored in bounded LRU maps).
 ‣ Cancels an in-flight SendQueue whenever a new message from that user arrives.
 """
 from __future__ import annotations
 import dotenv
+import logging, os
 import threading, asyncio, time
-from typing import Dict
 
 import telebot
-from redis import Redis
 from rq import Queue
 
 from core.chunker import Chunker
-from core.send_queue import SendQueue
+from core.redis_pool import cancel_channel, shared
+from core.user_lru import UserLRU
 
 # --------------------------------------------------------------------- #
 #  Config
 # --------------------------------------------------------------------- #
 dotenv.load_dotenv()
+logger = logging.getLogger(__name__)
 BOT_TOKEN = dotenv.get_key("../.env", "TG_BOT_TOKEN")         # botfather token
-redis = Redis()
+redis = shared
 rq_queue = Queue(connection=redis)
 
 loop = asyncio.new_event_loop()
 threading.Thread(target=loop.run_forever, daemon=True).start()
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# Handlers mostly wait on Redis/asyncio, so a wide pool lets users overlap.
+HANDLER_THREADS = 32
+POLL_TIMEOUT = 50                  # seconds Telegram holds an idle getUpdates
 
-# Per-user state
-chunkers: Dict[int, Chunker] = {}
-send_queues: Dict[int, SendQueue] = {}
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", num_threads=HANDLER_THREADS)
+
+
+# Per-user state, bounded to recently active users
+MAX_TRACKED_USERS = 10_000
+chunkers = UserLRU(MAX_TRACKED_USERS, evictable=lambda ch: ch.idle)   # keep unsent text
+send_queues = UserLRU(MAX_TRACKED_USERS)
 
 # --------------------------------------------------------------------- #
 #  Helper to send a message (telebot is sync, so wrap in loop.run_in_executor)
@@ -46,7 +54,9 @@ def _sync_send(user_id: int, text: str):
 
 
 def _sync_reset_elapsed(user_id: int):
-    chunkers[user_id].reset_elapsed()
+    ch = chunkers.get(user_id)
+    if ch is not None:
+        ch.reset_elapsed()
 
 
 async def send_part_old(user_id: int, text: str):
@@ -58,10 +68,37 @@ async def reset_elapsed(user_id: int):
     cur_loop.run_in_executor(None, _sync_reset_elapsed, user_id)
 
 
-async def send_part(user_id: int, text: str):
-    # always get the loop that’s actually running this coroutine
-    cur_loop = asyncio.get_running_loop()
-    await cur_loop.run_in_executor(None, _sync_send, user_id, text)
+def _signal_cancel(user_id: int, cancel_key: str):
+    """Interrupt the worker's SendQueue for this user.
+
+    The publish reaches an active flush instantly; the short-lived key covers
+    a reply whose job has started but whose flush has not subscribed yet.
+    A job still queued is not cancelled: process_thought clears the key
+    when it starts.
+    """
+    with redis.pipeline(transaction=False) as pipe:
+        pipe.set(cancel_key, "1", ex=10)  # expires in 10 seconds
+        pipe.publish(cancel_channel(user_id), "1")
+        pipe.execute()
+
+
+async def _collect_thought(ch: Chunker, user_id: int, text: str):
+    thought = await ch.feed(text)
+
+    if thought:                     # a full "thought" is ready
+        logger.debug("💡 Thought formed for user %s: %r", user_id, thought)
+        # enqueue background job for the worker (sync Redis → threadpool)
+        job = await loop.run_in_executor(
+            None, rq_queue.enqueue, "app.worker.process_thought", user_id, thought
+        )
+        logger.info("📋 Enqueued job %s for user %s", job.id, user_id)
+    else:
+        logger.debug("⏳ No thought formed yet for user %s, waiting for more input", user_id)
+
+
+def _report_failure(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("❌ Failed to collect thought", exc_info=fut.exception())
 
 # --------------------------------------------------------------------- #
 #  Incoming message handler
@@ -70,7 +107,7 @@ async def send_part(user_id: int, text: str):
 def on_message(message: telebot.types.Message):
     user_id = message.from_user.id
     text = message.text
-    print(f"📥 BOT: Received message from user {user_id}: '{text}'")
+    logger.debug("📥 Received message from user %s: %r", user_id, text)
 
     # ---------------- cancel an in-flight bot reply ------------------ #
     sq = send_queues.get(user_id)
@@ -84,7 +121,7 @@ def on_message(message: telebot.types.Message):
     # Check for response currently being streamed
     if redis.exists(response_started_key):
         response_started_time = float(redis.get(response_started_key).decode())
-        print(f"🔄 BOT: Response currently streaming (started {time.time() - response_started_time:.1f}s ago)")
+        logger.debug("🔄 Response currently streaming (started %.1fs ago)", time.time() - response_started_time)
         response_in_progress = True
     # Check for recent completed response that might still be relevant
     elif redis.exists(last_ai_time_key):
@@ -92,46 +129,45 @@ def on_message(message: telebot.types.Message):
         # Consider response in progress if it was within last 30 seconds
         if time.time() - last_ai_time < 30:
             response_in_progress = True
-            print(f"🔄 BOT: Recent response detected (last AI reply {time.time() - last_ai_time:.1f}s ago)")
+            logger.debug("🔄 Recent response detected (last AI reply %.1fs ago)", time.time() - last_ai_time)
     
     if sq:
-        print(f"❌ BOT: Cancelling existing SendQueue for user {user_id}")
+        logger.info("❌ Cancelling existing SendQueue for user %s", user_id)
         sq.cancel()                 # stop any queued parts immediately
-        # Also set Redis cancellation signal for worker's SendQueue
-        redis.set(cancel_key, "1", ex=10)  # expires in 10 seconds
-        print(f"🚩 BOT: Set Redis cancel signal '{cancel_key}' (expires in 10s)")
+        # Also signal the worker's SendQueue
+        _signal_cancel(user_id, cancel_key)
     elif response_in_progress:
-        print(f"❌ BOT: No local SendQueue but response in progress, setting cancel signal")
-        # Set Redis cancellation signal for worker's SendQueue
-        redis.set(cancel_key, "1", ex=10)  # expires in 10 seconds
-        print(f"🚩 BOT: Set Redis cancel signal '{cancel_key}' (expires in 10s)")
+        logger.info("❌ Response in progress for user %s, publishing cancel signal", user_id)
+        # Signal the worker's SendQueue
+        _signal_cancel(user_id, cancel_key)
     else:
-        print(f"ℹ️ BOT: No response in progress, not setting cancel signal")
+        logger.debug("ℹ️ No response in progress, not setting cancel signal")
 
     # ---------------- feed text into the user's chunker -------------- #
-    ch = chunkers.setdefault(user_id, Chunker(timeout=1.5, user_id=user_id))
-    print(f"🧠 BOT: Using chunker for user {user_id}")
+    ch = chunkers.get_or_create(
+        user_id, lambda: Chunker(timeout=1.5, user_id=user_id, redis_conn=redis)
+    )
 
-    # Chunker is async, pytelegrambotapi is sync → delegate to event-loop
-    print(f"🔄 BOT: Feeding text to chunker...")
-    thought = asyncio.run_coroutine_threadsafe(ch.feed(text), loop).result()
-    print(f"🔄 BOT: Chunker.feed() completed")
-
-    if thought:                     # a full "thought" is ready
-        print(f"💡 BOT: Thought formed: '{thought}'")
-        # enqueue background job for the worker
-        job = rq_queue.enqueue("app.worker.process_thought", user_id, thought)
-        print(f"📋 BOT: Enqueued job {job.id} for worker")
-    else:
-        print(f"⏳ BOT: No thought formed yet, waiting for more input...")
+    # Chunker is async, pytelegrambotapi is sync → delegate to event-loop.
+    # Don't wait: the thought only forms after the chunker's timeout.
+    fut = asyncio.run_coroutine_threadsafe(_collect_thought(ch, user_id, text), loop)
+    fut.add_done_callback(_report_failure)
 
 
 # --------------------------------------------------------------------- #
 #  Start polling (blocking)
 # --------------------------------------------------------------------- #
 def main():
-    print("Bot is polling…")
-    bot.infinity_polling()          # will reconnect on errors
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    logger.info("Bot is polling…")
+    bot.infinity_polling(           # will reconnect on errors
+        timeout=POLL_TIMEOUT,
+        long_polling_timeout=POLL_TIMEOUT,
+        skip_pending=True,
+    )
 
 
 if __name__ == "__main__":
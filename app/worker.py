@@ -1,30 +1,58 @@
 # app/worker.py
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
 import time
+import threading
 
-import requests
 import asyncio
 import dotenv
-import json
-import httpx
+from contextlib import aclosing
+from typing import AsyncIterator, Optional
 
-from redis import Redis
 from rq import SimpleWorker
 
-from urllib.parse import quote
-
 from services.llm_gateway import LLMGateway
 from core.context_manager import ContextManager
+from core.redis_pool import shared
 from core.send_queue import SendQueue
-from app.telegram_bot import send_part, reset_elapsed   # re-use the bot’s sender
+from core.user_lru import UserLRU
+from services.telegram_sender import send_part   # no bot/polling in the worker
+
+logger = logging.getLogger(__name__)
+
+redis_conn = shared                       # pooled, see core/redis_pool.py
+
+# One event loop for the life of the worker process: the LLM client's
+# keep-alive connections stay bound to it across jobs. Both are created on
+# first use, so importing this module (RQ, spawn's __mp_main__) is free.
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_llm: Optional[LLMGateway] = None
+
+
+def get_worker_loop() -> asyncio.AbstractEventLoop:
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+        threading.Thread(target=_worker_loop.run_forever, daemon=True).start()
+    return _worker_loop
 
-redis_conn = Redis()                      # host/port/db kwargs as needed
 
-llm = LLMGateway(api_url="https://api.openai.com/v1/chat/completions",
-                 api_key=dotenv.get_key("../.env", "OPENAI_API_KEY"),
-                 model=dotenv.get_key("../.env", "LLM_MODEL") or "gpt-3.5-turbo")
+def get_llm() -> LLMGateway:
+    global _llm
+    if _llm is None:
+        _llm = LLMGateway(api_url="https://api.openai.com/v1/chat/completions",
+                          api_key=dotenv.get_key("../.env", "OPENAI_API_KEY"),
+                          model=dotenv.get_key("../.env", "LLM_MODEL") or "gpt-3.5-turbo")
+    return _llm
 
-# Global context managers per user (will be created per request)
-user_contexts = {}
+# Context managers (each mirrors up to read_window messages) for the users
+# this process served most recently; an evicted one reloads from Redis
+MAX_CACHED_CONTEXTS = 1_000
+user_contexts = UserLRU(MAX_CACHED_CONTEXTS)
 
 
 def strip_trailing_period(text: str) -> str:
@@ -32,120 +60,170 @@ def strip_trailing_period(text: str) -> str:
     return text[:-1] if text.endswith('.') else text
 
 
+def reply_part(line: str) -> str:
+    """A reply line minus any `speaker:` prefix and trailing period."""
+    head, sep, tail = line.partition(":")
+    return strip_trailing_period((tail if sep else head).strip())
+
+
+async def _reply_parts(prompt: str) -> AsyncIterator[str]:
+    """Reply parts as the LLM streams them, one per non-blank line."""
+    async with aclosing(get_llm().stream_lines(prompt)) as lines:
+        async for line in lines:
+            part = reply_part(line)
+            if part:
+                yield part
+
+
+async def _stream_reply(prompt: str, sendq: SendQueue):
+    parts = _reply_parts(prompt)
+    try:
+        await sendq.flush(parts)
+    finally:
+        await parts.aclose()        # stop reading the LLM stream if cancelled
+
+
 def process_thought(user_id: int, thought: str):
-    print(f"🚀 WORKER: Starting process_thought for user {user_id}")
-    print(f"🚀 WORKER: Thought content: '{thought}'")
+    logger.info("🚀 Starting process_thought for user %s", user_id)
+    logger.debug("🚀 Thought content: %r", thought)
     
-    # Check if cancel signal exists before clearing
     cancel_key = f"cancel_reply:{user_id}"
-    signal_exists_before = redis_conn.exists(cancel_key)
-    print(f"🔍 WORKER: Cancel signal exists BEFORE clear: {signal_exists_before}")
-    
-    # Clear any existing cancel signal - we're starting a new response
-    deleted_count = redis_conn.delete(cancel_key)
-    print(f"🧹 WORKER: Deleted cancel signal, count: {deleted_count}")
-    
-    # Set response started timestamp so bot knows we're streaming
     response_started_key = f"response_started:{user_id}"
-    redis_conn.set(response_started_key, time.time(), ex=120)  # expires in 2 minutes
-    print(f"🚀 WORKER: Set response_started timestamp")
-    
-    # Verify signal is actually cleared
-    signal_exists_after = redis_conn.exists(cancel_key)
-    print(f"✅ WORKER: Cancel signal exists AFTER clear: {signal_exists_after}")
+    with redis_conn.pipeline(transaction=False) as pipe:
+        # Clear any existing cancel signal - we're starting a new response
+        pipe.delete(cancel_key)
+        # Set response started timestamp so bot knows we're streaming
+        pipe.set(response_started_key, time.time(), ex=120)  # expires in 2 minutes
+        deleted_count, _ = pipe.execute()
+    logger.debug("🧹 Deleted cancel signal (%d), set response_started timestamp", deleted_count)
     
     # Get or create context manager for this user
-    if user_id not in user_contexts:
-        print(f"📝 WORKER: Creating new context manager for user {user_id}")
-        user_contexts[user_id] = ContextManager(user_id, redis_conn)
-    else:
-        print(f"📝 WORKER: Using existing context manager for user {user_id}")
-    ctx = user_contexts[user_id]
+    def new_context():
+        logger.debug("📝 Creating new context manager for user %s", user_id)
+        return ContextManager(user_id, redis_conn)
+    ctx = user_contexts.get_or_create(user_id, new_context)
     
     # Add user message to persistent storage
-    print(f"💾 WORKER: Adding user message to context: '{thought}'")
     ctx.add("user", thought)
     
     # Get OpenAI-formatted messages for better context handling
     messages = ctx.get_openai_messages()
-    print(f"📚 WORKER: Retrieved {len(messages)} context messages")
-    print(f"📚 WORKER: Last 3 messages: {messages[-3:] if len(messages) >= 3 else messages}")
     
     # Convert to old format for current LLM gateway compatibility
     prompt = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
-    print(f"🎯 WORKER: Generated prompt length: {len(prompt)} chars")
-    
-    # Run LLM request with proper event loop handling
-    llm_start_time = time.time()
-    print(f"🤖 WORKER: Calling LLM API...")
-    try:
-        reply_text = asyncio.run(llm.chat(prompt))
-        llm_processing_time = time.time() - llm_start_time
-        print(f"✅ WORKER: LLM API call successful in {llm_processing_time:.2f}s")
-    except RuntimeError as e:
-        if "Event loop is closed" in str(e):
-            print(f"⚠️ WORKER: Event loop closed, recreating client...")
-            # Recreate the LLM client and try again
-            llm._client = httpx.AsyncClient(
-                timeout=30.0,
-                trust_env=False,
-                http2=False,
-                headers={"Accept-Encoding": "identity"}
-            )
-            reply_text = asyncio.run(llm.chat(prompt))
-            llm_processing_time = time.time() - llm_start_time
-            print(f"✅ WORKER: LLM API call successful after retry in {llm_processing_time:.2f}s")
-        else:
-            print(f"❌ WORKER: LLM API error: {e}")
-            raise
-    
-    print(f"📝 WORKER: LLM Reply length: {len(reply_text)} chars")
-    print(f"📝 WORKER: LLM Reply preview: '{reply_text[:200]}...'")
-
-    parts = [strip_trailing_period(p.strip()[p.find(":") + 1:].strip()) for p in reply_text.split("\n") if p.strip()]
-    print(f"📦 WORKER: Split into {len(parts)} parts")
-    print(f"📦 WORKER: Parts: {parts}")
+    logger.debug("🎯 Prompt from %d context messages, %d chars", len(messages), len(prompt))
     
     # Track which parts were actually sent
     sent_parts = []
     def track_sender(txt):
-        # Final cancellation check right before sending to Telegram
-        cancel_key = f"cancel_reply:{user_id}"
-        if redis_conn.exists(cancel_key):
-            print(f"❌ WORKER: Final cancellation check - NOT sending part: '{txt}'")
-            return asyncio.ensure_future(asyncio.sleep(0))  # Return completed future
-        
-        print(f"📤 WORKER: SENDING part: '{txt}'")
+        # SendQueue has already checked its (pub/sub-driven) cancel event
         sent_parts.append(txt)
-        return asyncio.ensure_future(send_part(user_id, txt))
+        return send_part(user_id, txt)
     
-    print(f"🚀 WORKER: Creating SendQueue for user {user_id}")
-    sendq = SendQueue(track_sender, user_id=user_id, llm_processing_time=llm_processing_time)
+    sendq = SendQueue(track_sender, user_id=user_id, redis_conn=redis_conn)
     
-    print(f"💨 WORKER: Starting sendq.flush() with {len(parts)} parts (LLM took {llm_processing_time:.2f}s)")
-    asyncio.run(sendq.flush(parts))
-    print(f"✅ WORKER: sendq.flush() completed")
-    
-    print(f"📊 WORKER: Actually sent {len(sent_parts)} out of {len(parts)} parts")
-    print(f"📊 WORKER: Sent parts: {sent_parts}")
-    
-    redis_conn.set(f"last_ai_reply:{user_id}", time.time())
-    print(f"⏰ WORKER: Set last_ai_reply timestamp")
+    # Stream the LLM reply straight into the SendQueue on the worker's
+    # persistent loop: the first part's typing delay overlaps generation
+    logger.debug("💨 Streaming reply for user %s", user_id)
+    reply = asyncio.run_coroutine_threadsafe(_stream_reply(prompt, sendq), get_worker_loop())
+    try:
+        reply.result()
+    except BaseException:
+        # RQ's job timeout or a cold stop interrupted the wait: cancel the
+        # reply too, or it keeps sending on the loop after the job failed
+        reply.cancel()
+        raise
     
     # Store ONLY the parts that were actually sent
-    print(f"💾 WORKER: Storing {len(sent_parts)} sent parts to context")
-    for i, p in enumerate(sent_parts):
-        print(f"💾 WORKER: Storing part {i+1}: '{p}'")
-        ctx.add("assistant", p)
+    ctx.add_many(("assistant", p) for p in sent_parts)
     
-    # Clear response started timestamp - we're done
-    response_started_key = f"response_started:{user_id}"
-    redis_conn.delete(response_started_key)
-    print(f"🏁 WORKER: Cleared response_started timestamp")
+    with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.set(f"last_ai_reply:{user_id}", time.time())
+        # Clear response started timestamp - we're done
+        pipe.delete(response_started_key)
+        pipe.execute()
     
-    print(f"🎉 WORKER: process_thought completed for user {user_id}")
+    logger.info("🎉 process_thought completed for user %s: sent %d parts", user_id, len(sent_parts))
 
 
-if __name__ == "__main__":
+def _configure_logging():
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+
+def _run_worker(supervised: bool = False):
+    if supervised:
+        # Own process group: a terminal Ctrl-C reaches only the supervisor,
+        # which forwards it once (a second signal makes RQ cold-stop)
+        os.setpgrp()
+    _configure_logging()
     worker = SimpleWorker(queues=["default"], connection=redis_conn)
-    worker.work()
+    try:
+        worker.work()
+    finally:
+        if _llm is not None:
+            asyncio.run_coroutine_threadsafe(_llm.aclose(), _worker_loop).result(timeout=5)
+
+
+def _supervise(concurrency: int) -> int:
+    """Run `concurrency` worker processes until stopped; returns the exit code.
+
+    SIGTERM/SIGINT are forwarded to every child so each does RQ's warm
+    shutdown (finishes its reply). If a child exits on its own, the rest are
+    stopped and we exit non-zero, so the container's restart policy brings
+    the full pool back instead of running short-handed.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_run_worker, kwargs={"supervised": True}, name=f"worker-{i}")
+             for i in range(concurrency)]
+    stopping = False
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc in procs:
+            if proc.pid is not None and proc.exitcode is None:
+                os.kill(proc.pid, signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for proc in procs:
+        if stopping:
+            break
+        proc.start()
+
+    started = {proc.sentinel: proc for proc in procs if proc.pid is not None}
+    ready = multiprocessing.connection.wait(started)   # until the first child exits
+    crashed = not stopping
+    if crashed:
+        dead = started[ready[0]]
+        dead.join()
+        logger.error("💥 %s exited with code %s, stopping the pool", dead.name, dead.exitcode)
+        forward(signal.SIGTERM, None)
+    for proc in started.values():
+        proc.join()
+    return 1 if crashed else 0
+
+
+def main():
+    # SimpleWorker runs jobs in-process, so the worker loop and the LLM
+    # client's keep-alive connections survive between jobs (a forking rq
+    # Worker would drop both per job). Concurrency comes from N spawned
+    # processes, each with its own loop and Redis pool.
+    concurrency = int(os.environ.get("WORKER_CONCURRENCY", 1))
+    if concurrency <= 1:
+        _run_worker()
+    else:
+        _configure_logging()
+        sys.exit(_supervise(concurrency))
+
+
+if __name__ == "__main__":
+    # Run through the importable module, not this __main__ copy: RQ resolves
+    # jobs as app.worker.process_thought, and the spawned children's target
+    # must pickle as app.worker._run_worker, so there is a single module
+    # state whose gateway _run_worker closes.
+    from app import worker
+    worker.main()
@@ -1,26 +1,40 @@
 from __future__ import annotations
 import asyncio
+import logging
 import time
 from redis import Redis
 from typing import List, Optional
 
+from core.redis_pool import shared
+
+logger = logging.getLogger(__name__)
+
 
 class Chunker:
     """Accumulates user messages into a single *thought*.
 
-    A thought is emitted when no new text arrives for `timeout` seconds, **and**
+    A thought is emitted once no new text arrives for `timeout` seconds (one
+    timer, re-armed by every message), **and** the user has written since
+    the bot's last reply.
 
     Example:
-        chunker = Chunker(timeout=1.5)
-        async for thought in chunker.feed_stream(message_stream):
+        chunker = Chunker(timeout=1.5, user_id=user_id)
+        thought = await chunker.feed(text)   # None if a later message took over
+        if thought:
             ...  # send to worker
     """
 
-    def __init__(self, timeout: float = 1.5, user_id: int = 0):
+    # A buffer untouched this long (its thought failed to emit) may be dropped
+    STALE_AFTER = 3600.0
+
+    def __init__(self, timeout: float = 1.5, user_id: int = 0, redis_conn: Optional[Redis] = None):
         self.timeout = timeout
         self._buffer: List[str] = []
         self._last_ts: float | None = None
-        self.redis = Redis()
+        self._fed_at = time.monotonic()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._pending: Optional[asyncio.Future] = None
+        self.redis = redis_conn or shared
 
         if user_id == 0:
             raise ValueError("Default user-id specified")
@@ -30,36 +44,58 @@ class Chunker:
     def _condition_met(self) -> bool:
         if not self._buffer or self._last_ts is None:
             return False
-        gap_ok = (time.time() - (self._last_ts or time.time())) >= self.timeout
 
-        print(time.time(), self._last_ts)
-        print(f"Elapsed time: {time.time() - (self._last_ts or time.time())}")
+        last_ai_time = self.redis.get(f"last_ai_reply:{self.user_id}")
+        if last_ai_time is not None and self._last_ts < float(last_ai_time):
+            return False
 
-        if self.redis.exists(f"last_ai_reply:{self.user_id}"):
-            last_ai_time = float(self.redis.get(f"last_ai_reply:{self.user_id}").decode())
-            if self._last_ts < last_ai_time:
-                return False
+        return True
 
-        return gap_ok
+    @property
+    def idle(self) -> bool:
+        """Nothing buffered, or only a stale buffer: safe to drop."""
+        return not self._buffer or time.monotonic() - self._fed_at > self.STALE_AFTER
 
     def reset_elapsed(self):
         self._last_ts = None
 
+    def _emit(self):
+        """Timer callback: `timeout` seconds passed since the last message."""
+        self._timer = None
+        pending, self._pending = self._pending, None
+        if pending is None or pending.done():
+            return                  # nobody is waiting; keep the buffer
+
+        thought = None
+        try:
+            if self._condition_met():
+                logger.debug("Formed thought for user %s from %d messages", self.user_id, len(self._buffer))
+                thought = " ".join(self._buffer)
+                self._buffer.clear()
+        except Exception as exc:
+            # e.g. Redis unreachable: fail the waiting feed() rather than
+            # leave it hanging; the buffer is kept for the next message
+            pending.set_exception(exc)
+            return
+        pending.set_result(thought)
+
     async def feed(self, msg: str) -> Optional[str]:
         """Feed a single incoming telegram message.
-        Returns a *thought* string if completed, else None.
+        Resolves with the *thought* once `timeout` seconds pass without
+        another message, or with None if a later message supersedes it.
         """
 
-        print(f"Received message to buffer!")
+        loop = asyncio.get_running_loop()
         self._buffer.append(msg)
-        await asyncio.sleep(0)  # yield control
-        if self._condition_met():
-            print("Formed thought")
-            thought = " ".join(self._buffer)
-            self._buffer.clear()
-            self._last_ts = time.time()
-            return thought
-
+        self._fed_at = time.monotonic()
+        # Wall clock on purpose: compared with the worker's last_ai_reply
         self._last_ts = time.time()
-        return None
-    
\ No newline at end of file
+
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._pending is not None and not self._pending.done():
+            self._pending.set_result(None)      # the newest feed() owns the thought
+
+        self._pending = pending = loop.create_future()
+        self._timer = loop.call_later(self.timeout, self._emit)
+        return await pending
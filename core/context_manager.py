@@ -1,54 +1,139 @@
 import json
 import time
-import uuid
+from collections import deque
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Deque, Dict, Any, Iterable, Optional, Tuple
+
+import msgpack
 from redis import Redis
 
+from core.redis_pool import shared
+
+# Messages are stored as msgpack `(timestamp, role_code, content)` tuples;
+# entries written before that are JSON dicts and are still read.
+_ROLES = ("user", "assistant")
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+# Raised by unpackb/json.loads on corrupt entries, or by a bad shape/role code
+_DECODE_ERRORS = (ValueError, TypeError, IndexError, KeyError)
+
 
 class ContextManager:
     """Rolling time‑window memory (default 6h, but min 100 msgs). 
-    Stores ALL messages persistently in Redis, but only loads recent ones for context."""
+    Stores ALL messages persistently in Redis, but only loads recent ones for context.
 
-    def __init__(self, user_id: int, redis_conn: Redis, max_age_hours: int = 6, min_msgs: int = 100):
+    `chat_history:<uid>` (newest first) is trimmed server-side to
+    4 * min_msgs entries and is what context reads scan; every message is
+    also appended to the untrimmed `chat_archive:<uid>` for export. Users
+    whose history predates the archive get it seeded from the full
+    `chat_history` list before the first trim.
+
+    The read window is mirrored in-process, so context reads skip Redis.
+    The archive length returned by each write tells us whether another
+    process wrote in between; if so the mirror is dropped and reloaded."""
+
+    def __init__(self, user_id: int, redis_conn: Optional[Redis] = None, max_age_hours: int = 6, min_msgs: int = 100):
         self.user_id = user_id
-        self.redis_conn = redis_conn
+        self.redis_conn = redis_conn or shared
         self.max_age_seconds = max_age_hours * 3600
         self.min_msgs = min_msgs
         self.redis_key = f"chat_history:{user_id}"
+        self.archive_key = f"chat_archive:{user_id}"
+        self.max_stored = min_msgs * 4      # LTRIM bound for redis_key
+        self.read_window = min_msgs * 2     # entries scanned per context read
+        # Chronological mirror of the newest `read_window` entries, loaded lazily
+        self._cache: Optional[Deque[Dict[str, Any]]] = None
+        self._cache_len = 0                 # archive length the mirror matches
+        self._archive_ready = False         # archive exists or was seeded
+
+    @staticmethod
+    def _encode(msg: Dict[str, Any]) -> bytes:
+        return msgpack.packb((msg["timestamp"], _ROLE_CODES[msg["role"]], msg["content"]))
+
+    @staticmethod
+    def _decode(raw: bytes) -> Dict[str, Any]:
+        try:
+            timestamp, role_code, content = msgpack.unpackb(raw)
+        except _DECODE_ERRORS:
+            # Legacy JSON entry; ages out of chat_history through the trim
+            msg = json.loads(raw)
+            return {"timestamp": msg["timestamp"], "role": msg["role"], "content": msg["content"]}
+        return {"timestamp": timestamp, "role": _ROLES[role_code], "content": content}
+
+    def _seed_archive(self):
+        """Copy pre-archive history (untrimmed, newest first) into the archive
+        oldest first, once, if the archive does not exist yet. WATCHed so
+        two processes can't both seed it."""
+        def seed(pipe):
+            if pipe.exists(self.archive_key):
+                return
+            legacy = pipe.lrange(self.redis_key, 0, -1)
+            pipe.multi()
+            if legacy:
+                pipe.rpush(self.archive_key, *reversed(legacy))
+
+        self.redis_conn.transaction(seed, self.archive_key, self.redis_key)
+        self._archive_ready = True
 
     def add(self, role: str, content: str):
         """Add a message to persistent storage. Role should be 'user' or 'assistant'."""
-        message = {
-            "timestamp": time.time(),
-            "role": role,
-            "content": content,
-            "message_id": str(uuid.uuid4())
-        }
-        
-        # Store message permanently in Redis list
-        self.redis_conn.lpush(self.redis_key, json.dumps(message))
+        self.add_many([(role, content)])
+
+    def add_many(self, messages: Iterable[Tuple[str, str]]):
+        """Add several `(role, content)` messages in one pipelined round-trip."""
+        now = int(time.time())
+        new = [{"timestamp": now, "role": role, "content": content} for role, content in messages]
+        if not new:
+            return
+        encoded = [self._encode(msg) for msg in new]
+        if not self._archive_ready:
+            self._seed_archive()        # before the LTRIM below drops old history
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            pipe.lpush(self.redis_key, *encoded)
+            pipe.ltrim(self.redis_key, 0, self.max_stored - 1)
+            # Store message permanently in the untrimmed archive
+            pipe.rpush(self.archive_key, *encoded)
+            archive_len = pipe.execute()[-1]
+
+        if self._cache is not None and archive_len == self._cache_len + len(new):
+            self._cache.extend(new)
+            self._cache_len = archive_len
+        else:
+            self._cache = None          # someone else wrote too; reload on next read
+
+    def _load_cache(self) -> Deque[Dict[str, Any]]:
+        # MULTI so the window and the archive length come from one snapshot
+        with self.redis_conn.pipeline() as pipe:
+            pipe.lrange(self.redis_key, 0, self.read_window - 1)
+            pipe.llen(self.archive_key)
+            raw_messages, archive_len = pipe.execute()
+
+        cache = deque(maxlen=self.read_window)
+        # Stored newest first; appendleft leaves the mirror chronological
+        for raw_msg in raw_messages:
+            try:
+                cache.appendleft(self._decode(raw_msg))
+            except _DECODE_ERRORS:
+                continue
+        self._cache = cache
+        self._cache_len = archive_len
+        return cache
 
     def get_recent_messages(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """Get recent messages within the time window for OpenAI context."""
         now = time.time()
         cutoff_time = now - self.max_age_seconds
         
-        # Get all messages from Redis (they're stored newest first)
-        raw_messages = self.redis_conn.lrange(self.redis_key, 0, -1)
+        cache = self._cache if self._cache is not None else self._load_cache()
         messages = []
         
-        for raw_msg in raw_messages:
-            try:
-                msg = json.loads(raw_msg.decode('utf-8'))
-                # Include message if it's within time window OR we haven't hit min_msgs yet
-                if msg['timestamp'] >= cutoff_time or len(messages) < self.min_msgs:
-                    messages.append(msg)
-                elif len(messages) >= self.min_msgs:
-                    # We have enough recent messages, stop processing older ones
-                    break
-            except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
-                continue
+        # Walk newest first
+        for msg in reversed(cache):
+            # Include message if it's within time window OR we haven't hit min_msgs yet
+            if msg['timestamp'] >= cutoff_time or len(messages) < self.min_msgs:
+                messages.append(msg)
+            else:
+                # We have enough recent messages, stop processing older ones
+                break
         
         # Reverse to get chronological order (oldest first)
         messages.reverse()
@@ -77,24 +162,24 @@ class ContextManager:
 
     def get_full_history(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """Get complete message history (for export/admin purposes)."""
-        raw_messages = self.redis_conn.lrange(self.redis_key, 0, limit - 1 if limit else -1)
+        # The archive is stored oldest first, so the newest `limit` are at the tail
+        raw_messages = self.redis_conn.lrange(self.archive_key, -limit if limit else 0, -1)
         messages = []
         
         for raw_msg in raw_messages:
             try:
-                msg = json.loads(raw_msg.decode('utf-8'))
-                messages.append(msg)
-            except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
+                messages.append(self._decode(raw_msg))
+            except _DECODE_ERRORS:
                 continue
         
-        # Reverse to get chronological order
-        messages.reverse()
         return messages
 
     def clear_history(self):
         """Clear all message history for this user."""
-        self.redis_conn.delete(self.redis_key)
+        self.redis_conn.delete(self.redis_key, self.archive_key)
+        self._cache = deque(maxlen=self.read_window)
+        self._cache_len = 0
 
     def get_message_count(self) -> int:
         """Get total number of stored messages."""
-        return self.redis_conn.llen(self.redis_key)
+        return self.redis_conn.llen(self.archive_key)
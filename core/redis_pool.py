@@ -0,0 +1,35 @@
+"""Process-wide Redis connection pool.
+
+Every component (bot, worker, Chunker, ContextManager, SendQueue, RQ) borrows
+connections from the same pool instead of opening its own `Redis()`.
+"""
+import os
+
+from redis import ConnectionPool, Redis
+from redis.asyncio import Redis as AsyncRedis
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+
+POOL = ConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    max_connections=64,
+    socket_keepalive=True,
+)
+
+shared = Redis(connection_pool=POOL)
+
+
+def async_client() -> AsyncRedis:
+    """Fresh asyncio client for pub/sub listeners.
+
+    asyncio connections are bound to the loop that opened them, so these are
+    not pooled with `shared`; SendQueue keeps one per event loop.
+    """
+    return AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, socket_keepalive=True)
+
+
+def cancel_channel(user_id: int) -> str:
+    """Pub/sub channel the bot publishes to when a user interrupts a reply."""
+    return f"cancel:{user_id}"
@@ -1,81 +1,229 @@
 import random
 import math
 import asyncio
-from typing import Iterable, Callable, Optional
+import inspect
+import logging
+import time
+import weakref
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Set, Union
 from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from core.redis_pool import async_client, cancel_channel, shared
+
+logger = logging.getLogger(__name__)
+
+# Backoff between attempts to resubscribe after the pub/sub connection drops
+RESUBSCRIBE_BASE = 0.025
+RESUBSCRIBE_CAP = 2.0
+
+Parts = Union[Iterable[str], AsyncIterable[str]]
+
+_mono = time.monotonic      # typing delays are intervals; immune to clock steps
 
 
 class SendQueue:
     """Streams multi‑part replies with human‑typing delays.
 
+    While flushing, a pub/sub subscription on `cancel:<user_id>` sets the
+    local cancel event, so a cross-process `cancel()` costs no polling. The
+    subscription rides on one pub/sub connection per event loop (see
+    `_CancelSubscriptions`), so a flush costs a SUBSCRIBE, not a connect.
+
     Args:
-        sender: an async callable `(text:str) -> None` that actually sends a message.
+        sender: a callable `(text:str)` that actually sends a message; it may
+            return an awaitable (coroutine/future) or send synchronously.
         cps: average characters per second.
         jitter: multiplicative ± randomness.
     """
 
-    def __init__(self, sender: Callable[[str], asyncio.Future], cps: float = 8.5, jitter: float = 0.6, user_id: Optional[int] = None, llm_processing_time: float = 0.0):
+    def __init__(self, sender: Callable[[str], Optional[Awaitable[None]]], cps: float = 8.5, jitter: float = 0.6, user_id: Optional[int] = None, llm_processing_time: float = 0.0,
+                 redis_conn: Optional[Redis] = None):
         self.sender = sender
         self.cps = cps
         self.jitter = jitter
         self.user_id = user_id
         self.llm_processing_time = llm_processing_time
         self._cancel = asyncio.Event()
-        self._redis = Redis() if user_id else None
+        self._redis = (redis_conn or shared) if user_id else None
 
     def cancel(self):
         self._cancel.set()
 
-    async def flush(self, parts: Iterable[str]):
-        print(f"🔄 SENDQUEUE: Starting flush for user {self.user_id} with {len(list(parts))} parts")
-        parts = list(parts)  # Convert back to list since we consumed it
-        
-        for i, part in enumerate(parts):
-            print(f"🔍 SENDQUEUE: Processing part {i+1}/{len(parts)}: '{part}'")
-            
-            # Check for Redis cancellation signal before each part
-            if self._redis and self.user_id:
-                cancel_key = f"cancel_reply:{self.user_id}"
-                signal_exists = self._redis.exists(cancel_key)
-                print(f"🔍 SENDQUEUE: Checking cancel signal '{cancel_key}': {signal_exists}")
-                
-                if signal_exists:
-                    print(f"❌ SENDQUEUE: CANCELLATION DETECTED! Stopping at part {i+1}")
-                    # Clear the signal and cancel
-                    self._redis.delete(cancel_key)
-                    print(f"🧹 SENDQUEUE: Cleared cancel signal")
-                    return
-            
-            base_delay = len(part) / (self.cps * random.uniform(1 - self.jitter, 1 + self.jitter))
-            
-            # For the first part, subtract LLM processing time
-            if i == 0 and self.llm_processing_time > 0:
-                delay = max(0, base_delay - self.llm_processing_time)
-                print(f"⏰ SENDQUEUE: First part - base delay {base_delay:.2f}s minus LLM time {self.llm_processing_time:.2f}s = {delay:.2f}s")
-            else:
-                delay = base_delay
-                print(f"⏰ SENDQUEUE: Waiting {delay:.2f}s before sending part {i+1}")
-            
-            try:
-                await asyncio.wait_for(self._cancel.wait(), timeout=delay)
-                print(f"❌ SENDQUEUE: Local cancel event triggered at part {i+1}")
+    def _consume_cancel_key(self) -> bool:
+        """DEL both checks and clears the bot's fallback cancel key."""
+        return bool(self._redis.delete(f"cancel_reply:{self.user_id}"))
+
+    async def flush(self, parts: Parts):
+        """Send `parts` with typing delays. `parts` may be a list or an async
+        iterator (e.g. a streaming LLM reply); time already spent waiting
+        for a streamed part counts towards its typing delay."""
+        logger.debug("🔄 Starting flush for user %s", self.user_id)
+
+        if not (self._redis and self.user_id):
+            return await self._flush(parts)
+
+        subscriptions = _cancel_subscriptions()
+        await subscriptions.add(self)
+        try:
+            # A cancel raised after the job started but before we subscribed
+            # (context load, LLM request) only left the key behind
+            if self._consume_cancel_key():
+                logger.debug("❌ Cancelled before first part (user %s)", self.user_id)
                 return
-            except asyncio.TimeoutError:
-                print(f"✅ SENDQUEUE: Timeout completed, sending part {i+1}")
-                pass
-            
-            print(f"📤 SENDQUEUE: About to call sender for part {i+1}")
-            
-            # Check for cancellation one more time right before sending
-            if self._redis and self.user_id:
-                cancel_key = f"cancel_reply:{self.user_id}"
-                if self._redis.exists(cancel_key):
-                    print(f"❌ SENDQUEUE: Last-second cancellation detected before sending part {i+1}")
-                    self._redis.delete(cancel_key)
+            await self._flush(parts)
+        finally:
+            await subscriptions.remove(self)
+
+    async def _flush(self, parts: Parts):
+        # One long-lived waiter on the cancel event, raced against a plain
+        # sleep per part, and against the next part of a streamed reply (one
+        # can take a whole generation step); no wait_for/TimeoutError churn.
+        cancelled = asyncio.ensure_future(self._cancel.wait())
+        source = _aiter(parts)
+        upcoming: Optional[asyncio.Future] = None
+        sent = 0
+        # Loop invariants for the per-part jitter draw
+        uniform, cps = random.uniform, self.cps
+        jitter_lo, jitter_hi = 1 - self.jitter, 1 + self.jitter
+        try:
+            # Typing of a part "starts" once the previous one is out
+            typing_since = _mono()
+            while True:
+                upcoming = asyncio.ensure_future(source.__anext__())
+                await asyncio.wait({cancelled, upcoming}, return_when=asyncio.FIRST_COMPLETED)
+                if not upcoming.done():
+                    logger.debug("❌ Cancel event triggered awaiting part %d", sent + 1)
                     return
+                try:
+                    part = upcoming.result()
+                except StopAsyncIteration:
+                    break
+                base_delay = len(part) / (cps * uniform(jitter_lo, jitter_hi))
+                
+                # Subtract time already spent producing this part (and, for
+                # the first part, any LLM processing time before the flush)
+                elapsed = _mono() - typing_since
+                if sent == 0:
+                    elapsed += self.llm_processing_time
+                delay = max(0, base_delay - elapsed)
+                logger.debug("⏰ Part %d: base delay %.2fs minus %.2fs elapsed = %.2fs",
+                             sent + 1, base_delay, elapsed, delay)
+                
+                if delay > 0:
+                    sleep = asyncio.ensure_future(asyncio.sleep(delay))
+                    await asyncio.wait({cancelled, sleep}, return_when=asyncio.FIRST_COMPLETED)
+                    sleep.cancel()
+                
+                # Also catches a cancel that landed right before sending
+                if self._cancel.is_set():
+                    logger.debug("❌ Cancel event triggered at part %d", sent + 1)
+                    return
+                
+                res = self.sender(part)
+                if inspect.isawaitable(res):
+                    await res
+                sent += 1
+                typing_since = _mono()
+        finally:
+            cancelled.cancel()
+            if upcoming is not None and not upcoming.done():
+                # Ends the part source (closing e.g. the LLM's HTTP stream)
+                # before our caller gets to aclose() it
+                upcoming.cancel()
+                await asyncio.wait({upcoming})
             
-            await self.sender(part)
-            print(f"✅ SENDQUEUE: Successfully sent part {i+1}")
-            
-        print(f"🎉 SENDQUEUE: All parts sent successfully")
+        logger.debug("🎉 All %d parts sent for user %s", sent, self.user_id)
         self._cancel.clear()
+
+
+class _CancelSubscriptions:
+    """Cancel channels of every flushing SendQueue on one event loop, all on
+    a single pub/sub connection kept for the loop's life (the worker's
+    persistent loop). One reader task dispatches published cancels
+    and subscribe confirmations; it exits while nothing is subscribed."""
+
+    def __init__(self):
+        self._pubsub = async_client().pubsub()
+        self._queues: Dict[bytes, Set[SendQueue]] = {}
+        self._acks: Dict[bytes, asyncio.Future] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    async def add(self, sq: SendQueue):
+        """Subscribe `sq` to its user's cancel channel and wait for the ack."""
+        channel = cancel_channel(sq.user_id).encode()
+        self._queues.setdefault(channel, set()).add(sq)
+        ack = self._acks[channel] = asyncio.get_running_loop().create_future()
+        try:
+            await self._pubsub.subscribe(channel)
+        except BaseException:
+            await self.remove(sq)
+            raise
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+        await asyncio.wait({ack}, timeout=1.0)   # the subscribe confirmation
+        if self._acks.get(channel) is ack:
+            del self._acks[channel]
+
+    async def remove(self, sq: SendQueue):
+        channel = cancel_channel(sq.user_id).encode()
+        queues = self._queues.get(channel)
+        if queues is None:
+            return
+        queues.discard(sq)
+        if queues:
+            return                  # another flush for this user still listens
+        del self._queues[channel]
+        try:
+            await self._pubsub.unsubscribe(channel)
+        except RedisConnectionError as e:
+            # Resubscribed on reconnect; messages for it are simply ignored
+            logger.warning("⚠️ Could not unsubscribe %s (%s)", channel, e)
+
+    async def _read(self):
+        backoff = RESUBSCRIBE_BASE
+        while self._pubsub.subscribed:
+            try:
+                async for message in self._pubsub.listen():
+                    channel = message["channel"]
+                    if message["type"] == "message":
+                        for sq in self._queues.get(channel, ()):
+                            logger.debug("❌ Cancel published for user %s", sq.user_id)
+                            sq.cancel()
+                    elif message["type"] == "subscribe":
+                        backoff = RESUBSCRIBE_BASE
+                        ack = self._acks.pop(channel, None)
+                        if ack is not None and not ack.done():
+                            ack.set_result(None)
+                            continue
+                        # Resubscribed after a drop: publishes sent meanwhile
+                        # are lost, but the bot's key is not
+                        for sq in tuple(self._queues.get(channel, ())):
+                            if sq._consume_cancel_key():
+                                sq.cancel()
+            except RedisConnectionError as e:
+                logger.warning("⚠️ Cancel subscription lost (%s), retrying in ~%.3fs", e, backoff)
+                await asyncio.sleep(backoff * random.uniform(0.9, 1.1))
+                backoff = min(backoff * 2, RESUBSCRIBE_CAP)
+
+
+_subscriptions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _CancelSubscriptions]" = weakref.WeakKeyDictionary()
+
+
+def _cancel_subscriptions() -> _CancelSubscriptions:
+    """The running loop's shared cancel subscriptions (asyncio connections
+    are bound to the loop that opened them)."""
+    loop = asyncio.get_running_loop()
+    subscriptions = _subscriptions.get(loop)
+    if subscriptions is None:
+        subscriptions = _subscriptions[loop] = _CancelSubscriptions()
+    return subscriptions
+
+
+async def _aiter(parts: Parts) -> AsyncIterator[str]:
+    if hasattr(parts, "__aiter__"):
+        async for part in parts:
+            yield part
+    else:
+        for part in parts:
+            yield part
@@ -0,0 +1,47 @@
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Callable, Optional
+
+
+class UserLRU:
+    """Thread-safe per-user map that keeps only the `maxsize` most recently
+    active users. Eviction drops the least recently used entry that
+    `evictable` accepts (e.g. a Chunker with no buffered text), never the
+    one just created; if none qualifies the map grows past `maxsize` until
+    older entries qualify."""
+
+    def __init__(self, maxsize: int, evictable: Callable[[Any], bool] = lambda value: True):
+        self.maxsize = maxsize
+        self.evictable = evictable
+        self._data: OrderedDict[int, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, keep: int):
+        """Drop the oldest evictable entries, other than `keep`, until the
+        map is back to `maxsize` (or nothing else qualifies)."""
+        excess = len(self._data) - self.maxsize
+        candidates = (user_id for user_id, value in self._data.items()     # oldest first
+                      if user_id != keep and self.evictable(value))
+        victims = list(islice(candidates, excess))
+        for user_id in victims:
+            del self._data[user_id]
+
+    def get(self, user_id: int) -> Optional[Any]:
+        with self._lock:
+            value = self._data.get(user_id)
+            if value is not None:
+                self._data.move_to_end(user_id)
+            return value
+
+    def get_or_create(self, user_id: int, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            value = self._data.get(user_id)
+            if value is None:
+                value = self._data[user_id] = factory()
+                if len(self._data) > self.maxsize:
+                    self._evict(keep=user_id)
+            else:
+                self._data.move_to_end(user_id)
+            return value
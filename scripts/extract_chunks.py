@@ -10,13 +10,90 @@ A chunk is defined as:
 
 import json
 import argparse
+import mmap
 import os
+import sys
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import accumulate
+from operator import attrgetter
 import re
+from collections import Counter
 
-@dataclass
+try:
+    import orjson
+except ImportError:        # optional: stdlib json is ~3-5x slower on large exports
+    orjson = None
+
+try:
+    import ijson
+except ImportError:        # optional: without it the whole export is loaded at once
+    ijson = None
+
+try:
+    import numpy as np
+except ImportError:        # optional: chunk statistics fall back to plain Python
+    np = None
+
+# WhatsApp export line: [DD/MM/YYYY, HH:MM:SS] User Name: Message text
+# (a blank body never matches, as when lines were strip()ped; trailing
+# blanks and the CR of CRLF exports stay out of the text)
+_WHATSAPP_RE = re.compile(
+    rb'^[ \t]*\[(\d{1,2}/\d{1,2}/\d{4}), (\d{1,2}:\d{2}:\d{2})\] ([^:\n]+): (.*\S)[ \t\r]*$',
+    re.MULTILINE,
+)
+
+
+# Bursts of messages share the same second, so repeated timestamp strings
+# are common; datetimes are immutable and safe to hand out from a cache.
+_TS_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=_TS_CACHE_SIZE)
+def _parse_wa_ts(date_b: bytes, time_b: bytes) -> datetime:
+    """[DD/MM/YYYY, HH:MM:SS] -> datetime, falling back to MM/DD for US exports.
+
+    Fields are 1-2 digits wide, so split instead of slicing; the regex has
+    already guaranteed digits. Raises ValueError if neither order is a date.
+    """
+    d, m, y = date_b.split(b'/')
+    hh, mm, ss = time_b.split(b':')
+    d, m, y, hh, mm, ss = int(d), int(m), int(y), int(hh), int(mm), int(ss)
+    try:
+        return datetime(y, m, d, hh, mm, ss)
+    except ValueError:
+        return datetime(y, d, m, hh, mm, ss)
+
+
+@lru_cache(maxsize=_TS_CACHE_SIZE)
+def _parse_tg_ts(s: str) -> datetime:
+    """Telegram export date -> datetime. Raises ValueError if unparseable."""
+    if 'T' in s:
+        # ISO format: 2023-12-01T15:30:45
+        return datetime.fromisoformat(s[:-1] + '+00:00' if s[-1:] == 'Z' else s)
+    if len(s) == 19 and s[4] == s[7] == '-' and s[10] == ' ' and s[13] == s[16] == ':':
+        return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                        int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    # Other formats
+    return datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _loads = orjson.loads
+    _dumps = lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+else:
+    _loads = json.loads
+    _dumps = lambda obj: json.dumps(obj, indent=2, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+@dataclass(slots=True)
 class Message:
     """Represents a single chat message."""
     timestamp: datetime
@@ -25,7 +102,7 @@ class Message:
     text: str
     message_id: Optional[str] = None
 
-@dataclass
+@dataclass(slots=True)
 class Chunk:
     """Represents a chunk of consecutive messages from the same user."""
     user_id: str
@@ -38,12 +115,13 @@ class Chunk:
     total_chars: int
     
     def to_dict(self) -> Dict[str, Any]:
+        # datetimes are left as-is: _dumps writes them in ISO format
         return {
             "user_id": self.user_id,
             "user_name": self.user_name,
             "messages": self.messages,
-            "start_time": self.start_time.isoformat(),
-            "end_time": self.end_time.isoformat(),
+            "start_time": self.start_time,
+            "end_time": self.end_time,
             "duration_seconds": self.duration_seconds,
             "message_count": self.message_count,
             "total_chars": self.total_chars
@@ -64,67 +142,49 @@ class ChatHistoryParser:
         """
         print(f"📱 Parsing Telegram export: {file_path}")
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
         messages = []
         
-        # Handle different export formats
-        if 'messages' in data:
-            message_list = data['messages']
-        elif isinstance(data, list):
-            message_list = data
-        else:
-            raise ValueError("Unknown export format")
-        
-        for msg_data in message_list:
+        for msg_data in self._iter_telegram_messages(file_path):
             # Skip system messages, service messages, etc.
             if msg_data.get('type') != 'message':
                 continue
                 
             # Skip messages without text
-            if not msg_data.get('text'):
+            text = msg_data.get('text')
+            if not text:
                 continue
             
             # Extract text (handle different formats)
-            text = msg_data.get('text', '')
-            if isinstance(text, list):
-                # Handle rich text format
-                text_parts = []
-                for part in text:
-                    if isinstance(part, str):
-                        text_parts.append(part)
-                    elif isinstance(part, dict) and 'text' in part:
-                        text_parts.append(part['text'])
-                text = ''.join(text_parts)
+            if type(text) is list:
+                # Handle rich text format: plain strings and {"type": ..., "text": ...}
+                text = ''.join(
+                    part if type(part) is str else part.get('text', '') if type(part) is dict else ''
+                    for part in text
+                )
             
             # Skip empty messages
-            if not text.strip():
+            text = text.strip()
+            if not text:
                 continue
             
             # Parse timestamp
             date_str = msg_data.get('date', '')
             try:
-                if 'T' in date_str:
-                    # ISO format: 2023-12-01T15:30:45
-                    timestamp = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                else:
-                    # Other formats
-                    timestamp = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+                timestamp = _parse_tg_ts(date_str)
             except ValueError:
                 print(f"⚠️  Could not parse timestamp: {date_str}")
                 continue
             
-            # Extract user info
-            user_id = str(msg_data.get('from_id', msg_data.get('from', 'unknown')))
-            user_name = msg_data.get('from', msg_data.get('from_id', 'Unknown User'))
+            # Extract user info (interned: a chat has few users but many messages)
+            user_id = sys.intern(str(msg_data.get('from_id', msg_data.get('from', 'unknown'))))
+            user_name = sys.intern(str(msg_data.get('from', msg_data.get('from_id', 'Unknown User'))))
             message_id = str(msg_data.get('id', ''))
             
             message = Message(
                 timestamp=timestamp,
                 user_id=user_id,
-                user_name=str(user_name),
-                text=text.strip(),
+                user_name=user_name,
+                text=text,
                 message_id=message_id
             )
             messages.append(message)
@@ -132,6 +192,26 @@ class ChatHistoryParser:
         print(f"   • Parsed {len(messages)} messages")
         return messages
     
+    def _iter_telegram_messages(self, file_path: str):
+        """Yield raw message dicts, streaming them with ijson when available."""
+        with open(file_path, 'rb') as f:
+            if ijson is not None:
+                # Handle different export formats: {"messages": [...]} or a bare list
+                head = f.read(64).lstrip()
+                f.seek(0)
+                prefix = 'item' if head[:1] == b'[' else 'messages.item'
+                yield from ijson.items(f, prefix, use_float=True)
+                return
+            data = _loads(f.read())
+        
+        # Handle different export formats
+        if 'messages' in data:
+            yield from data['messages']
+        elif isinstance(data, list):
+            yield from data
+        else:
+            raise ValueError("Unknown export format")
+    
     def parse_whatsapp_export(self, file_path: str) -> List[Message]:
         """
         Parse WhatsApp chat export.
@@ -141,39 +221,37 @@ class ChatHistoryParser:
         
         messages = []
         
-        # WhatsApp export pattern
-        pattern = r'\[(\d{1,2}/\d{1,2}/\d{4}, \d{1,2}:\d{2}:\d{2})\] ([^:]+): (.+)'
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                
-                match = re.match(pattern, line)
-                if not match:
-                    continue
-                
-                date_str, user_name, text = match.groups()
-                
-                try:
-                    # Parse WhatsApp timestamp format
-                    timestamp = datetime.strptime(date_str, '%d/%m/%Y, %H:%M:%S')
-                except ValueError:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                print(f"   • Parsed 0 messages")
+                return messages          # mmap cannot map an empty file
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                line_num, pos = 1, 0
+                for match in _WHATSAPP_RE.finditer(buf):
+                    start = match.start()
+                    line_num += buf[pos:start].count(b'\n')
+                    pos = start
+                    
+                    date_b, time_b, user_b, text_b = match.groups()
+                    
                     try:
-                        timestamp = datetime.strptime(date_str, '%m/%d/%Y, %H:%M:%S')
+                        timestamp = _parse_wa_ts(date_b, time_b)
                     except ValueError:
+                        date_str = f"{date_b.decode()}, {time_b.decode()}"
                         print(f"⚠️  Could not parse timestamp on line {line_num}: {date_str}")
                         continue
-                
-                message = Message(
-                    timestamp=timestamp,
-                    user_id=user_name.lower().replace(' ', '_'),
-                    user_name=user_name,
-                    text=text.strip(),
-                    message_id=str(line_num)
-                )
-                messages.append(message)
+                    
+                    # Interned: a chat has few users but many messages
+                    user_name = sys.intern(user_b.decode('utf-8'))
+                    message = Message(
+                        timestamp=timestamp,
+                        user_id=sys.intern(user_name.lower().replace(' ', '_')),
+                        user_name=user_name,
+                        text=text_b.decode('utf-8').strip(),
+                        message_id=str(line_num)
+                    )
+                    messages.append(message)
         
         print(f"   • Parsed {len(messages)} messages")
         return messages
@@ -203,60 +281,22 @@ class ChatHistoryParser:
         print(f"\n🔗 Extracting chunks from {len(messages)} messages...")
         
         # Sort messages by timestamp
-        messages.sort(key=lambda m: m.timestamp)
-        
-        chunks = []
-        current_chunk_messages = []
-        current_user_id = None
-        chunk_start_time = None
-        
-        for i, message in enumerate(messages):
-            # Check if we should start a new chunk
-            should_start_new_chunk = False
-            
-            # Reason 1: Different user
-            if current_user_id is not None and message.user_id != current_user_id:
-                should_start_new_chunk = True
-                reason = "user_change"
-            
-            # Reason 2: Time gap > threshold
-            elif (current_chunk_messages and 
-                  message.timestamp - messages[i-1].timestamp > self.pause_threshold):
-                should_start_new_chunk = True
-                reason = "time_gap"
-            
-            # Reason 3: First message
-            elif current_user_id is None:
-                should_start_new_chunk = False  # Actually starting first chunk
-                reason = "first_message"
-            
-            # If we need to start a new chunk, save the current one
-            if should_start_new_chunk and current_chunk_messages:
-                chunk = self._create_chunk(
-                    current_user_id,
-                    current_chunk_messages,
-                    chunk_start_time,
-                    messages[i-1].timestamp
-                )
-                chunks.append(chunk)
-                current_chunk_messages = []
-            
-            # Add message to current chunk
-            if not current_chunk_messages:  # Starting new chunk
-                chunk_start_time = message.timestamp
-            
-            current_chunk_messages.append(message)
-            current_user_id = message.user_id
-        
-        # Don't forget the last chunk
-        if current_chunk_messages:
-            chunk = self._create_chunk(
-                current_user_id,
-                current_chunk_messages,
-                chunk_start_time,
-                current_chunk_messages[-1].timestamp
+        messages.sort(key=attrgetter('timestamp'))
+        
+        # Every chunk start except the first, then slice between them;
+        # char_ends[i] is the text length of messages[:i]
+        bounds = [0, *self._chunk_starts(messages), len(messages)]
+        char_ends = list(accumulate((len(m.text) for m in messages), initial=0))
+        chunks = [
+            self._create_chunk(
+                messages[start].user_id,
+                messages[start:end],
+                messages[start].timestamp,
+                messages[end - 1].timestamp,
+                char_ends[end] - char_ends[start]
             )
-            chunks.append(chunk)
+            for start, end in zip(bounds, bounds[1:])
+        ]
         
         print(f"   • Extracted {len(chunks)} chunks")
         
@@ -265,11 +305,24 @@ class ChatHistoryParser:
         
         return chunks
     
+    def _chunk_starts(self, messages: List[Message]) -> List[int]:
+        """Indices of sorted messages that open a new chunk: a different
+        user, or a gap to the previous message above the pause threshold."""
+        starts = []
+        prev = messages[0]
+        for i in range(1, len(messages)):
+            message = messages[i]
+            # Reason 1: Different user / Reason 2: Time gap > threshold
+            if (message.user_id != prev.user_id or
+                    message.timestamp - prev.timestamp > self.pause_threshold):
+                starts.append(i)
+            prev = message
+        return starts
+    
     def _create_chunk(self, user_id: str, messages: List[Message], 
-                     start_time: datetime, end_time: datetime) -> Chunk:
+                     start_time: datetime, end_time: datetime, total_chars: int) -> Chunk:
         """Create a Chunk object from a list of messages."""
         message_texts = [msg.text for msg in messages]
-        total_chars = sum(len(text) for text in message_texts)
         duration = (end_time - start_time).total_seconds()
         
         return Chunk(
@@ -290,49 +343,64 @@ class ChatHistoryParser:
         
         print(f"\n📊 CHUNK STATISTICS:")
         
-        # Basic stats
-        total_messages = sum(chunk.message_count for chunk in chunks)
-        avg_messages_per_chunk = total_messages / len(chunks)
+        n = len(chunks)
+        if np is not None:
+            message_counts = np.fromiter((chunk.message_count for chunk in chunks), dtype=np.int64, count=n)
+            durations = np.fromiter((chunk.duration_seconds for chunk in chunks), dtype=np.float64, count=n)
+            durations = durations[durations > 0]
+            total_messages = int(message_counts.sum())
+            min_count, max_count = int(message_counts.min()), int(message_counts.max())
+            avg_duration = float(durations.mean()) if durations.size else None
+            max_duration = float(durations.max()) if durations.size else None
+        else:
+            message_counts = [chunk.message_count for chunk in chunks]
+            durations = [chunk.duration_seconds for chunk in chunks if chunk.duration_seconds > 0]
+            total_messages = sum(message_counts)
+            min_count, max_count = min(message_counts), max(message_counts)
+            avg_duration = sum(durations) / len(durations) if durations else None
+            max_duration = max(durations) if durations else None
         
-        print(f"   • Total chunks: {len(chunks)}")
+        # Basic stats
+        print(f"   • Total chunks: {n}")
         print(f"   • Total messages: {total_messages}")
-        print(f"   • Avg messages per chunk: {avg_messages_per_chunk:.1f}")
+        print(f"   • Avg messages per chunk: {total_messages / n:.1f}")
         
         # Message count distribution
-        message_counts = [chunk.message_count for chunk in chunks]
-        print(f"   • Min messages in chunk: {min(message_counts)}")
-        print(f"   • Max messages in chunk: {max(message_counts)}")
+        print(f"   • Min messages in chunk: {min_count}")
+        print(f"   • Max messages in chunk: {max_count}")
         
         # Duration stats
-        durations = [chunk.duration_seconds for chunk in chunks if chunk.duration_seconds > 0]
-        if durations:
-            print(f"   • Avg chunk duration: {sum(durations) / len(durations):.1f}s")
-            print(f"   • Max chunk duration: {max(durations):.1f}s")
+        if avg_duration is not None:
+            print(f"   • Avg chunk duration: {avg_duration:.1f}s")
+            print(f"   • Max chunk duration: {max_duration:.1f}s")
         
-        # User distribution
-        user_counts = {}
-        for chunk in chunks:
-            user_counts[chunk.user_name] = user_counts.get(chunk.user_name, 0) + 1
+        # User distribution (most_common keeps first-seen order on ties)
+        user_counts = Counter(chunk.user_name for chunk in chunks)
         
         print(f"   • Users found: {len(user_counts)}")
-        for user, count in sorted(user_counts.items(), key=lambda x: x[1], reverse=True)[:5]:
+        for user, count in user_counts.most_common(5):
             print(f"     - {user}: {count} chunks")
     
     def save_chunks(self, chunks: List[Chunk], output_path: str):
         """Save chunks to JSON file."""
         print(f"\n💾 Saving {len(chunks)} chunks to: {output_path}")
         
-        chunk_data = {
-            "metadata": {
-                "total_chunks": len(chunks),
-                "extraction_time": datetime.now().isoformat(),
-                "pause_threshold_minutes": self.pause_threshold.total_seconds() / 60
-            },
-            "chunks": [chunk.to_dict() for chunk in chunks]
+        metadata = {
+            "total_chunks": len(chunks),
+            "extraction_time": datetime.now(),
+            "pause_threshold_minutes": self.pause_threshold.total_seconds() / 60
         }
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(chunk_data, f, indent=2, ensure_ascii=False)
+        # Streamed one chunk at a time: {"metadata": {...}, "chunks": [...]}
+        # without building the whole document in memory first
+        with open(output_path, 'wb') as f:
+            f.write(b'{"metadata": ')
+            f.write(_dumps(metadata))
+            f.write(b',\n"chunks": [')
+            for i, chunk in enumerate(chunks):
+                f.write(b',\n' if i else b'\n')
+                f.write(_dumps(chunk.to_dict()))
+            f.write(b'\n]}\n')
         
         print(f"   ✅ Saved successfully!")
 
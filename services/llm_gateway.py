@@ -1,10 +1,76 @@
+import asyncio
+import atexit
 import httpx
 import json
-import requests
-import asyncio
 import logging
+import queue
+import re
 import time
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, List, Optional
+
+try:
+    import orjson
+except ImportError:        # optional: faster log serialisation
+    orjson = None
+
+LOG_PREVIEW_CHARS = 500    # prompt/response chars kept per log line
+
+# System prompt between SYSTEM """ ... """ markers in the modelfile
+_SYS_RE = re.compile(r'SYSTEM """(.*?)"""', re.S)
+
+
+def _log_json(data: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _preview(text: str) -> str:
+    return text if len(text) <= LOG_PREVIEW_CHARS else f"{text[:LOG_PREVIEW_CHARS]}..."
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Enqueue records untouched; the listener thread formats them."""
+    def prepare(self, record):
+        return record
+
+
+class _AIRequestFormatter(logging.Formatter):
+    """Serialises the `ai_request` dict attached to a record, off the request path.
+
+    The record carries the full prompt and response; measuring and
+    truncating them happens here, in the listener thread.
+    """
+    _last_sec = None
+    _last_iso = ""
+
+    def _iso_timestamp(self, created: float) -> str:
+        """ISO local time for `record.created`; the date/time part is built
+        once per second (only the listener thread calls this)."""
+        sec = int(created)
+        if sec != self._last_sec:
+            self._last_sec, self._last_iso = sec, datetime.fromtimestamp(sec).isoformat()
+        return f"{self._last_iso}.{int((created - sec) * 1e6):06d}"
+
+    def format(self, record):
+        req = getattr(record, "ai_request", None)
+        if req is not None:
+            prompt, response = req["prompt"], req["response"]
+            log_data = {
+                "timestamp": self._iso_timestamp(record.created),
+                "model": req["model"],
+                "prompt_length": len(prompt),
+                "response_length": len(response),
+                "duration_seconds": round(req["duration"], 3),
+                "status_code": req["status_code"],
+                "prompt": _preview(prompt),
+                "response": _preview(response),
+            }
+            record.msg = f"AI_REQUEST: {_log_json(log_data)}"
+            record.args = None
+        return super().format(record)
 
 
 class LLMGateway:
@@ -12,171 +78,193 @@ class LLMGateway:
     If api_url points at an Ollama host (e.g. http://localhost:11434),
     we use its /api/chat endpoint. Otherwise default to OpenAI.
     """
+    _cached_prompt: str | None = None    # modelfile system prompt, read once per process
+
     def __init__(self, api_url: str | None = None, api_key: str | None = None,
                  model: str = "gpt-3.5-turbo"):
         self.api_url = api_url
         self.api_key = api_key
         self.model = model
+        # Backend, endpoint and auth never change per gateway; resolve them once
+        self._is_ollama = bool(api_url and "11434" in api_url)
+        self._endpoint = f"{api_url.rstrip('/')}/api/chat" if self._is_ollama else api_url
+        self._auth_headers = {"Authorization": f"Bearer {api_key}"} if api_key and not self._is_ollama else {}
         # self._client = httpx.AsyncClient(timeout=60.0)
         self._client = httpx.AsyncClient(
             timeout=30.0,
             trust_env=False,  # ignore any HTTP_PROXY
-            http2=False,  # force HTTP/1.1
+            http2=True,   # multiplex requests over one kept-alive connection (needs h2)
             headers={"Accept-Encoding": "identity"},
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
         )
+        # Caps chat_batch fan-out at the keep-alive pool size
+        self._sem = asyncio.Semaphore(32)
         self._setup_logging()
         self._load_system_prompt()
+        # Prepended to every OpenAI request; built once, never mutated
+        self._sys_msg = ({"role": "system", "content": self.system_prompt},) if self.system_prompt else ()
     
     def _setup_logging(self):
         """Setup logging for AI requests and responses"""
         self.logger = logging.getLogger("llm_gateway")
         if not self.logger.handlers:
             handler = logging.FileHandler("logs/ai_requests.log")
-            formatter = logging.Formatter(
+            formatter = _AIRequestFormatter(
                 "%(asctime)s - %(levelname)s - %(message)s"
             )
             handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            # Requests only enqueue; formatting and file writes happen on
+            # the listener thread, flushed at interpreter exit.
+            log_queue = queue.SimpleQueue()
+            listener = QueueListener(log_queue, handler)
+            listener.start()
+            atexit.register(listener.stop)
+            self.logger.addHandler(_DeferredQueueHandler(log_queue))
             self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False   # file only; keep it off the console handler
     
     def _log_request_response(self, prompt: str, response: str, duration: float, status_code: int = None):
-        """Log AI request and response with metadata"""
-        log_data = {
-            "timestamp": datetime.now().isoformat(),
+        """Log AI request and response with metadata (formatted by _AIRequestFormatter)"""
+        self.logger.info("AI_REQUEST", extra={"ai_request": {
             "model": self.model,
-            "prompt_length": len(prompt),
-            "response_length": len(response),
-            "duration_seconds": round(duration, 3),
+            "duration": duration,
             "status_code": status_code,
-            "prompt": prompt[:500] + "..." if len(prompt) > 500 else prompt,
-            "response": response[:500] + "..." if len(response) > 500 else response
-        }
-        self.logger.info(f"AI_REQUEST: {json.dumps(log_data, ensure_ascii=False)}")
+            "prompt": prompt,
+            "response": response,
+        }})
     
     def _load_system_prompt(self):
-        """Load system prompt from modelfile"""
-        try:
-            with open("../config/modelfile.txt", "r", encoding="utf-8") as f:
-                content = f.read()
-                # Extract content between SYSTEM """ markers
-                start = content.find('SYSTEM """')
-                if start != -1:
-                    start += len('SYSTEM """')
-                    end = content.find('"""', start)
-                    if end != -1:
-                        self.system_prompt = content[start:end].strip()
-                    else:
-                        self.system_prompt = None
-                        raise ValueError
+        """Load system prompt from modelfile (once per process)"""
+        if LLMGateway._cached_prompt is None:
+            try:
+                with open("../config/modelfile.txt", "r", encoding="utf-8") as f:
+                    match = _SYS_RE.search(f.read())
+            except FileNotFoundError:
+                match = None
+
+            if match is None:
+                self.system_prompt = None
+                raise ValueError
+            LLMGateway._cached_prompt = match.group(1).strip()
 
-                else:
-                    self.system_prompt = None
-                    raise ValueError
+        self.system_prompt = LLMGateway._cached_prompt
 
-        except FileNotFoundError:
-            self.system_prompt = None
-            raise ValueError
+    def _request(self, prompt: str, stream: bool):
+        """Build `(url, payload, headers)` for the configured backend."""
+        # --- OLLAMA branch ------------------------------------------- #
+        if self._is_ollama:
+            payload = {
+                "model": self.model,               # "gemma2:latest"
+                "messages": [{"role": "user", "content": prompt}],
+                "stream": stream
+            }
+            return self._endpoint, payload, self._auth_headers
 
+        # --- OPENAI branch ------------------------------- #
+        payload = {
+            "model": self.model,
+            "messages": [*self._sys_msg, {"role": "user", "content": prompt}],
+            "stream": stream
+        }
+        return self._endpoint, payload, self._auth_headers
 
+    async def aclose(self):
+        """Release the pooled connections; call from the loop that used them."""
+        await self._client.aclose()
 
     async def chat(self, prompt: str) -> str:
-        start_time = time.time()
+        start_time = time.perf_counter()
         response_text = ""
         status_code = None
         
         try:
-            # --- OLLAMA branch ------------------------------------------- #
-            if self.api_url and "11434" in self.api_url:
-                payload = {
-                    "model": self.model,               # "gemma2:latest"
-                    "messages": [{"role": "user", "content": prompt}],
-                    "stream": False                    # get one JSON blob back
-                }
-
-                r = await self._client.post(f"{self.api_url}/api/chat", json=payload, headers={"Connection": "close"})
-                status_code = r.status_code
-                r.raise_for_status()
-
-                data = r.json()
-                response_text = data["message"]["content"]
-                return response_text
-
-            # --- OPENAI branch ------------------------------- #
-            messages = []
-            if self.system_prompt:
-                messages.append({"role": "system", "content": self.system_prompt})
-            messages.append({"role": "user", "content": prompt})
-            
-            payload = {
-                "model": self.model,
-                "messages": messages,
-                "stream": False
-            }
-
-            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
-            r = await self._client.post(self.api_url, json=payload, headers=headers)
+            url, payload, headers = self._request(prompt, stream=False)
+            r = await self._client.post(url, json=payload, headers=headers)
             status_code = r.status_code
             r.raise_for_status()
+
             data = r.json()
-            response_text = data["choices"][0]["message"]["content"]
+            if self._is_ollama:   # Ollama: one JSON blob back
+                response_text = data["message"]["content"]
+            else:
+                response_text = data["choices"][0]["message"]["content"]
             return response_text
         
         finally:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             self._log_request_response(prompt, response_text, duration, status_code)
 
-    async def chat_bad(self, prompt: str) -> str:
-        """
-        Same signature, but uses `requests.post()` under the hood.
-        Runs the blocking call inside `run_in_executor` so this coroutine
-        still yields to the event-loop.
-        """
-        loop = asyncio.get_running_loop()
-
-        # -------- helper to turn payload + url into a curl string --------
-        def _curl(api, body, extra_hdrs=None):
-            hdrs = " ".join(
-                f"-H '{k}: {v}'" for k, v in (extra_hdrs or {}).items()
-            )
-            return (
-                f"curl -s -X POST {api} "
-                f"{hdrs} -H 'Content-Type: application/json' "
-                f"-d '{json.dumps(body, ensure_ascii=False)}' | jq"
-            )
+    async def _chat_sem(self, prompt: str) -> str:
+        async with self._sem:
+            return await self.chat(prompt)
 
-        # --- OLLAMA branch --------------------------------------------- #
-        if self.api_url and "11434" in self.api_url:
-            payload = {
-                "model": self.model,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": False,
-            }
-            api = f"{self.api_url.rstrip('/')}/api/chat"
-            print("\n=== CURL to reproduce request ===")
-            print(_curl(api, payload))
-            print("=======================================================\n")
+    async def chat_batch(self, prompts: List[str]) -> List[str]:
+        """`chat` for many prompts at once, at most 32 in flight; results
+        keep the order of `prompts`, and the first failure is raised."""
+        return await asyncio.gather(*(self._chat_sem(p) for p in prompts))
 
-            def _post():
-                r = requests.post(api, json=payload, timeout=120)  # 2-min cap
+    async def stream_lines(self, prompt: str) -> AsyncIterator[str]:
+        """Like `chat`, but streams the completion and yields each line as
+        soon as its newline arrives, so callers can start on the first line
+        while the model is still generating the rest."""
+        start_time = time.perf_counter()
+        end_time: Optional[float] = None
+        received: List[str] = []
+        status_code = None
+
+        try:
+            url, payload, headers = self._request(prompt, stream=True)
+            async with self._client.stream("POST", url, json=payload, headers=headers) as r:
+                status_code = r.status_code
                 r.raise_for_status()
-                return r.json()["message"]["content"]
 
-            return await loop.run_in_executor(None, _post)
+                # Callers pull lines lazily (SendQueue between typing delays),
+                # so read the stream ahead of them: the logged duration then
+                # ends with the model's output, not with the last send
+                deltas: asyncio.Queue = asyncio.Queue()
 
-        # --- OPENAI branch --------------------------------------------- #
-        payload = {
-            "model": self.model,
-            "messages": [{"role": "user", "content": prompt}],
-            "stream": False,
-        }
-        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
-        print("\n=== CURL to reproduce request ===")
-        print(_curl(self.api_url, payload, headers))
-        print("=======================================================\n")
+                async def read_ahead():
+                    nonlocal end_time
+                    try:
+                        async for delta in self._iter_deltas(r):
+                            received.append(delta)
+                            deltas.put_nowait(delta)
+                    finally:
+                        end_time = time.perf_counter()
+                        deltas.put_nowait(None)
 
-        def _post_openai():
-            r = requests.post(self.api_url, json=payload, headers=headers, timeout=120)
-            r.raise_for_status()
-            return r.json()["choices"][0]["message"]["content"]
+                reader = asyncio.create_task(read_ahead())
+                try:
+                    pending = ""
+                    while (delta := await deltas.get()) is not None:
+                        *lines, pending = (pending + delta).split("\n")
+                        for line in lines:
+                            yield line
+                    await reader            # re-raise a failed read
+                    if pending:
+                        yield pending
+                finally:
+                    # Closed early (e.g. cancelled reply): stop reading first
+                    reader.cancel()
+                    await asyncio.gather(reader, return_exceptions=True)
+
+        finally:
+            duration = (end_time or time.perf_counter()) - start_time
+            self._log_request_response(prompt, "".join(received), duration, status_code)
 
-        return await loop.run_in_executor(None, _post_openai)
+    @staticmethod
+    async def _iter_deltas(r: httpx.Response) -> AsyncIterator[str]:
+        """Text deltas from an Ollama NDJSON or OpenAI SSE stream."""
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            if line.startswith("data:"):           # OpenAI server-sent events
+                body = line[5:].strip()
+                if body == "[DONE]":
+                    return
+                choices = json.loads(body).get("choices")
+                delta = choices[0]["delta"].get("content") if choices else None
+            else:                                  # Ollama: one JSON object per line
+                delta = json.loads(line).get("message", {}).get("content")
+            if delta:
+                yield delta
@@ -0,0 +1,26 @@
+"""
+Outbound Telegram sends for processes that never poll (RQ workers).
+
+Importing this builds only an HTTP client — no TeleBot, polling thread,
+event loop or Redis connection, unlike importing app.telegram_bot.
+"""
+import dotenv
+import httpx
+
+BOT_TOKEN = dotenv.get_key("../.env", "TG_BOT_TOKEN")         # botfather token
+
+# Async Bot API client for outbound reply parts: one keep-alive pool, so a
+# multi-part reply pays TLS once instead of a threadpool hop + POST per part.
+tg_http = httpx.AsyncClient(
+    base_url=f"https://api.telegram.org/bot{BOT_TOKEN}/",
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=32, keepalive_expiry=75),
+)
+
+
+async def send_part(user_id: int, text: str):
+    r = await tg_http.post(
+        "sendMessage",
+        json={"chat_id": user_id, "text": text, "parse_mode": "HTML"},  # as TeleBot(parse_mode="HTML")
+    )
+    r.raise_for_status()